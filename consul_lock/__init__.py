@@ -4,5 +4,7 @@ from consul_lock.lock_impl import EphemeralLock
 from consul_lock.lock_impl import ConsulLockException
 from consul_lock.lock_impl import LockAcquisitionException
 
+from consul_lock.client import make_pooled_client
+
 from consul_lock import defaults
 
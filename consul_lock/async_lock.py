@@ -0,0 +1,235 @@
+"""
+asyncio flavor of `EphemeralLock`, for waiting on locks without tying up a thread.
+
+Requires aiohttp, which isn't installed with consul-lock by default:
+
+    pip install consul-lock[async]
+"""
+import asyncio
+import json
+from urllib.parse import quote
+
+import aiohttp
+
+from consul_lock import defaults
+from consul_lock.lock_impl import ConsulLockException
+from consul_lock.lock_impl import LockAcquisitionException
+from consul_lock.lock_impl import MAX_BLOCKING_WAIT_MS
+from consul_lock.lock_impl import blocking_query_wait
+from consul_lock.lock_impl import format_full_key
+from consul_lock.lock_impl import mono_ns
+from consul_lock.lock_impl import retry_jitter_ms
+from consul_lock.session_pool import SESSION_KWARGS
+
+
+# on top of the wait itself, allow this long for a blocking query to get an answer back
+_BLOCKING_QUERY_TIMEOUT_SLACK_SECONDS = 30
+
+# event loop -> the aiohttp session, and so keep-alive connection pool, shared by locks on that
+# loop which weren't given a session of their own. Closed with `close_http_session`.
+_http_sessions = {}
+
+
+def _get_http_session():
+    loop = asyncio.get_running_loop()
+    http_session = _http_sessions.get(loop)
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession()
+        _http_sessions[loop] = http_session
+    return http_session
+
+
+async def close_http_session():
+    """
+    Close the HTTP session shared by locks on the running event loop, call this before the loop
+    is closed (e.g. at the end of the coroutine passed to `asyncio.run`). Locks used afterwards
+    on the same loop start a new one.
+    """
+    http_session = _http_sessions.pop(asyncio.get_running_loop(), None)
+    if http_session is not None:
+        await http_session.close()
+
+
+class AsyncEphemeralLock(object):
+    """
+    Works like `EphemeralLock`, except `acquire` and `release` are coroutines and it is held with
+    `async with`. Consul's HTTP API is called directly with aiohttp.
+
+    Unlike `EphemeralLock`, locks on the same key in the same process aren't settled locally and
+    every lock gets a session of its own.
+
+    Unless given an `http_session`, locks share one aiohttp session per event loop, which has to
+    be closed with `close_http_session`.
+    """
+
+    __slots__ = (
+        '_base_uri',
+        '_headers',
+        '_params',
+        '_http_session',
+        'key',
+        'full_key',
+        'lock_timeout_seconds',
+        'acquire_timeout_ms',
+        'session_id',
+        '_started_locking',
+    )
+
+    def __init__(self,
+                 key,
+                 acquire_timeout_ms=None,
+                 lock_timeout_seconds=None,
+                 consul_client=None,
+                 http_session=None):
+        """
+        :param key: the unique key to lock
+        :param acquire_timeout_ms: how long the caller is willing to wait to acquire the lock
+        :param lock_timeout_seconds: how long the lock will stay alive if it is never released,
+            this is controlled by Consul's Session TTL and may stay alive a bit longer according
+            to their docs. As of the current version of Consul, this must be between 10s and 86400s
+        :param consul_client: client whose address, ACL token and datacenter to use instead of the
+            one defined in Settings, requests themselves are made with aiohttp
+        :param http_session: `aiohttp.ClientSession` to make requests with instead of the shared
+            one, it's left to the caller to close
+        """
+        consul_client = consul_client if consul_client is not None else defaults.consul_client
+        if consul_client is None:
+            raise Exception('consul_client is required for locking.')
+
+        self._base_uri = consul_client.http.base_uri
+        self._headers = {'X-Consul-Token': consul_client.token} if consul_client.token else None
+        self._params = {'dc': consul_client.dc} if consul_client.dc else {}
+        self._http_session = http_session
+
+        self.key = key
+        assert key, 'key is required for locking.'
+        self.full_key = format_full_key(key)
+        self.lock_timeout_seconds = lock_timeout_seconds if lock_timeout_seconds is not None \
+            else defaults.lock_timeout_seconds
+        self.acquire_timeout_ms = acquire_timeout_ms if acquire_timeout_ms is not None \
+            else defaults.acquire_timeout_ms
+        self.session_id = None
+        self._started_locking = False
+        assert 10 <= self.lock_timeout_seconds <= 86400, \
+            'lock_timeout_seconds must be between 10 and 86400 to due to Consul\'s session ttl settings'
+
+    async def acquire(self, fail_hard=True):
+        """
+        Attempt to acquire the lock.
+
+        :param fail_hard: when true, this method will only return gracefully
+            if the lock has been been acquired and will throw an exception if
+            it cannot acquire the lock.
+
+        :return: True if the lock was successfully acquired,
+            false if it was not (unreachable if failing hard)
+        """
+        assert not self._started_locking, 'can only lock once'
+        deadline = mono_ns() + int(self.acquire_timeout_ms) * 1000000
+
+        _, session = await self._request('PUT', '/v1/session/create', data=json.dumps({
+            'LockDelay': '%ss' % SESSION_KWARGS['lock_delay'],
+            'Behavior': SESSION_KWARGS['behavior'],
+            'TTL': '%ss' % self.lock_timeout_seconds,
+        }))
+        self.session_id = session['ID']
+
+        self._started_locking = True
+
+        while True:
+            is_success = await self._acquire_consul_key()
+
+            time_left_ms = (deadline - mono_ns()) // 1000000
+
+            if is_success or time_left_ms <= 0:
+                break
+
+            await self._wait_for_release(time_left_ms)
+
+            sleep_ms = retry_jitter_ms(deadline)
+            if sleep_ms > 0:
+                await asyncio.sleep(sleep_ms / 1000.0)
+
+        if not is_success and fail_hard:
+            raise LockAcquisitionException("Failed to acquire %s" % self.full_key)
+        else:
+            return is_success
+
+    async def _acquire_consul_key(self):
+        assert self.session_id, 'must have a session id to acquire lock'
+
+        _, is_success = await self._request(
+            'PUT',
+            '/v1/kv/%s' % self.full_key,
+            params={'acquire': self.session_id},
+            data=defaults.generate_value()
+        )
+        return is_success
+
+    async def _wait_for_release(self, time_left_ms):
+        """
+        Block until the key is modified (most likely released by its current holder),
+        or until `time_left_ms` runs out, using a Consul blocking query.
+        """
+        index, data = await self._request('GET', '/v1/kv/%s' % self.full_key)
+        if data is None or not data[0].get('Session'):
+            # the lock was freed right after our attempt, no reason to wait
+            return
+
+        # aiohttp's default 5 minute timeout is shorter than the longest blocking query
+        wait_seconds = min(time_left_ms, MAX_BLOCKING_WAIT_MS) / 1000.0
+        await self._request(
+            'GET',
+            '/v1/kv/%s' % self.full_key,
+            params={'index': index, 'wait': blocking_query_wait(time_left_ms)},
+            timeout=aiohttp.ClientTimeout(total=wait_seconds + _BLOCKING_QUERY_TIMEOUT_SLACK_SECONDS)
+        )
+
+    async def release(self):
+        """
+        Release the lock immediately. Does nothing if never locked.
+        """
+        if not self._started_locking:
+            return False
+
+        # same as EphemeralLock, destroying the session is the safest way to release the lock
+        _, is_destroyed = await self._request('PUT', '/v1/session/destroy/%s' % self.session_id)
+        return is_destroyed
+
+    async def _request(self, method, path, params=None, data=None, timeout=None):
+        """
+        :param timeout: `aiohttp.ClientTimeout` to use instead of the HTTP session's default
+        :return: tuple of (index, data), where data is None if Consul returned 404
+        """
+        if self._params:
+            params = dict(self._params, **(params or {}))
+
+        request_kwargs = {'params': params, 'data': data, 'headers': self._headers}
+        if timeout is not None:
+            request_kwargs['timeout'] = timeout
+
+        http_session = self._http_session if self._http_session is not None else _get_http_session()
+        async with http_session.request(
+                method,
+                self._base_uri + quote(path, safe='/:'),
+                **request_kwargs) as response:
+            body = await response.text()
+            index = response.headers.get('X-Consul-Index')
+            if response.status == 404:
+                return index, None
+            if response.status >= 400:
+                raise ConsulLockException('%d %s' % (response.status, body))
+            return index, json.loads(body)
+
+    async def __aenter__(self):
+        try:
+            await self.acquire(fail_hard=True)
+        except BaseException:
+            # __aexit__ won't run, don't leave the session around until its TTL
+            await self.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.release()
+        return False
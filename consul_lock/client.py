@@ -0,0 +1,22 @@
+import consul
+from requests.adapters import HTTPAdapter
+
+
+def make_pooled_client(host='127.0.0.1', port=8500, pool_connections=10, pool_maxsize=100, **kwargs):
+    """
+    Create a `consul.Consul` client whose requests reuse keep-alive connections, sized for many
+    threads locking concurrently. Creating the session, acquiring and releasing a lock then
+    share connections instead of opening new ones.
+
+    :param pool_connections: how many connection pools (one per Consul host) to keep
+    :param pool_maxsize: how many connections to keep open per pool, roughly the number of
+        threads expected to talk to Consul at the same time
+    :param kwargs: passed on to `consul.Consul`
+    """
+    client = consul.Consul(host=host, port=port, **kwargs)
+
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    client.http.session.mount('http://', adapter)
+    client.http.session.mount('https://', adapter)
+    client.http.session.headers['Connection'] = 'keep-alive'
+    return client
@@ -10,6 +10,13 @@ acquire_timeout_ms = 0
 
 lock_timeout_seconds = 60 * 3
 
+# share long-lived sessions between locks instead of creating one per lock,
+# see consul_lock.session_pool.SessionPool
+use_session_pool = False
+
+# destroy sessions from a background thread so releasing doesn't wait on Consul
+async_release = False
+
 # the key will always be substituted into the this pattern before locking,
 # a good prefix is recommended for organization
 lock_key_pattern = 'locks/ephemeral/%s'
@@ -17,10 +24,11 @@ lock_key_pattern = 'locks/ephemeral/%s'
 import json
 from datetime import datetime
 
+_encode = json.JSONEncoder(separators=(',', ':')).encode
+
 
 def _json_date_value():
-    return json.dumps(dict(
-        locked_at=str(datetime.now())
-    ))
+    # hand python-consul bytes so it's sent as is, ensure_ascii means nothing needs transcoding
+    return _encode({'locked_at': str(datetime.now())}).encode('ascii')
 
 generate_value = _json_date_value
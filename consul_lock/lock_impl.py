@@ -1,10 +1,35 @@
-import time
-import contextlib
+import base64
+import random
+import threading
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+from time import sleep as _sleep
+try:
+    from time import monotonic_ns as mono_ns
+except ImportError:  # python < 3.7
+    try:
+        from time import monotonic as _mono
+    except ImportError:  # python 2
+        from time import time as _mono
+
+    def mono_ns():
+        return int(_mono() * 1000000000)
 from consul_lock import defaults
+from consul_lock.session_pool import create_session
+from consul_lock.session_pool import get_session_pool
 
 import consul
 
 
+# Consul caps blocking queries at 10 minutes
+MAX_BLOCKING_WAIT_MS = 10 * 60 * 1000
+
+# upper bound of the random pause before retrying after a blocking query returns
+_RETRY_JITTER_MS = 50
+
+
 class ConsulLockException(consul.ConsulException):
     # Extends the base ConsulException in case caller wants to group the exception handling together
     pass
@@ -14,15 +39,123 @@ class LockAcquisitionException(ConsulLockException):
     pass
 
 
-def _coerce_required(value, attr_name):
-    if value is not None:
-        return value
+# (pattern, prefix, suffix) for the last seen defaults.lock_key_pattern, so building a full key
+# is a plain concatenation instead of re-parsing the format string for every lock
+_split_key_pattern = (None, '', '')
+
+
+def format_full_key(key):
+    """
+    :return: the Consul key for locking `key`, according to `defaults.lock_key_pattern`
+    """
+    global _split_key_pattern
+
+    pattern, prefix, suffix = _split_key_pattern
+    if pattern is not defaults.lock_key_pattern:
+        pattern = defaults.lock_key_pattern
+        prefix, _, suffix = (pattern % '\0').partition('\0')
+        _split_key_pattern = (pattern, prefix, suffix)
+
+    if not isinstance(key, str):
+        # same as formatting into the pattern, e.g. int keys, or unicode ones on python 2
+        key = '%s' % key
+
+    return prefix + key + suffix
+
+
+# full_key -> (lock, expires_at) for every lock currently held by this process. Locks on the same
+# key in the same process settle it here first, so only one of them at a time talks to Consul.
+_local_holders = {}
+_local_holders_changed = threading.Condition()
+
+
+def _acquire_local(lock, deadline):
+    """
+    Claim `lock.full_key` within this process, waiting until the `deadline` (monotonic ns) at most.
+    Like the Consul session, the claim lapses after `lock.lock_timeout_seconds`, except for locks
+    using the session pool, whose session keeps the key held in Consul until released.
+    """
+    with _local_holders_changed:
+        while True:
+            now = mono_ns()
+            holder = _local_holders.get(lock.full_key)
+            if holder is None or (holder[1] is not None and holder[1] <= now):
+                if lock.use_session_pool:
+                    # the same pooled session would happily re-acquire the key in Consul, so this
+                    # claim is all that keeps another lock in this process from holding it too
+                    expires_at = None
+                else:
+                    expires_at = now + lock.lock_timeout_seconds * 1000000000
+                _local_holders[lock.full_key] = (lock, expires_at)
+                return True
+
+            if deadline <= now:
+                return False
+
+            wait_until = deadline if holder[1] is None else min(deadline, holder[1])
+            _local_holders_changed.wait((wait_until - now) / 1e9)
+
+
+def _release_local(lock):
+    with _local_holders_changed:
+        holder = _local_holders.get(lock.full_key)
+        if holder is not None and holder[0] is lock:
+            del _local_holders[lock.full_key]
+            _local_holders_changed.notify_all()
+
+
+def blocking_query_wait(time_left_ms):
+    """
+    :return: the `wait` for a Consul blocking query that should return within `time_left_ms`
+    """
+    # Consul adds up to wait/16 of random jitter to the wait time, leave room for it so we
+    # don't overshoot the acquire timeout. A bit of our own jitter keeps waiters on the same
+    # key from all waking up in lockstep.
+    wait_ms = int(min(time_left_ms, MAX_BLOCKING_WAIT_MS)) * 16 // 17
+    wait_ms -= random.randint(0, wait_ms // 16)
+    return '%dms' % max(wait_ms, 1)
+
+
+def retry_jitter_ms(deadline):
+    """
+    :return: how long to sleep before retrying to acquire, without going past `deadline`
+    """
+    # every waiter wakes up when the lock is released, spread the retries out a little so they
+    # don't all hit Consul at the same instant. the blocking query already paces the retries,
+    # so this stays small rather than growing and letting newcomers cut in line
+    sleep_ms = random.randint(0, _RETRY_JITTER_MS)
+    return min((deadline - mono_ns()) // 1000000, sleep_ms)
+
+
+# (consul_client, session_id) of released locks whose sessions still need to be destroyed
+_destroy_queue = queue.Queue()
+_destroy_worker = None
+_destroy_worker_lock = threading.Lock()
+
+
+def _destroy_session_later(consul_client, session_id):
+    global _destroy_worker
+
+    with _destroy_worker_lock:
+        # a forked child inherits the parent's worker, but not its running thread
+        if _destroy_worker is None or not _destroy_worker.is_alive():
+            _destroy_worker = threading.Thread(target=_destroy_sessions)
+            _destroy_worker.daemon = True
+            _destroy_worker.start()
 
-    default = getattr(defaults, attr_name, None)
-    if default is not None:
-        return default
+    _destroy_queue.put((consul_client, session_id))
 
-    raise Exception('%s is required for locking.' % attr_name)
+
+def _destroy_sessions():
+    while True:
+        consul_client, session_id = _destroy_queue.get()
+        try:
+            consul_client.session.destroy(session_id=session_id)
+        except Exception:
+            # nobody is waiting on the result, and the session's TTL will clean it up regardless
+            pass
+        finally:
+            _destroy_queue.task_done()
 
 
 class EphemeralLock(object):
@@ -31,7 +164,7 @@ class EphemeralLock(object):
     application logic hot-spots. Locks are single use!
 
     Usable with `lock`/`release` in a try/finally block,
-    or more easily via the the `hold` method in a with block.
+    or more easily via the the `hold` method (or the lock itself) in a with block.
 
     Consul docs:
         https://www.consul.io/docs/internals/sessions.html
@@ -39,11 +172,26 @@ class EphemeralLock(object):
         https://github.com/hashicorp/consul/issues/968
     """
 
+    __slots__ = (
+        '_consul',
+        'key',
+        'full_key',
+        'lock_timeout_seconds',
+        'acquire_timeout_ms',
+        'use_session_pool',
+        'async_release',
+        'session_id',
+        '_session_is_shared',
+        '_started_locking',
+    )
+
     def __init__(self,
                  key,
                  acquire_timeout_ms=None,
                  lock_timeout_seconds=None,
-                 consul_client=None):
+                 consul_client=None,
+                 use_session_pool=None,
+                 async_release=None):
         """
         :param key: the unique key to lock
         :param acquire_timeout_ms: how long the caller is willing to wait to acquire the lock
@@ -51,17 +199,30 @@ class EphemeralLock(object):
             this is controlled by Consul's Session TTL and may stay alive a bit longer according
             to their docs. As of the current version of Consul, this must be between 10s and 86400s
         :param consul_client: client to use instead of the one defined in Settings
+        :param use_session_pool: acquire with a long-lived session shared with other locks
+            instead of creating one for this lock, see `consul_lock.session_pool.SessionPool`
+        :param async_release: destroy the session from a background thread on release instead of
+            waiting on Consul, has no effect when using the session pool
         """
-        self._consul = _coerce_required(consul_client, 'consul_client')
+        self._consul = consul_client if consul_client is not None else defaults.consul_client
+        if self._consul is None:
+            raise Exception('consul_client is required for locking.')
 
         self.key = key
         assert key, 'key is required for locking.'
-        self.full_key = defaults.lock_key_pattern % key
-        self.lock_timeout_seconds = _coerce_required(lock_timeout_seconds, 'lock_timeout_seconds')
-        self.acquire_timeout_ms = _coerce_required(acquire_timeout_ms, 'acquire_timeout_ms')
+        self.full_key = format_full_key(key)
+        self.lock_timeout_seconds = lock_timeout_seconds if lock_timeout_seconds is not None \
+            else defaults.lock_timeout_seconds
+        self.acquire_timeout_ms = acquire_timeout_ms if acquire_timeout_ms is not None \
+            else defaults.acquire_timeout_ms
+        self.use_session_pool = use_session_pool if use_session_pool is not None \
+            else defaults.use_session_pool
+        self.async_release = async_release if async_release is not None \
+            else defaults.async_release
         self.session_id = None
+        self._session_is_shared = False
         self._started_locking = False
-        assert self.lock_timeout_seconds >= 10 and self.lock_timeout_seconds <= 86400, \
+        assert 10 <= self.lock_timeout_seconds <= 86400, \
             'lock_timeout_seconds must be between 10 and 86400 to due to Consul\'s session ttl settings'
 
     def acquire(self, fail_hard=True):
@@ -76,53 +237,132 @@ class EphemeralLock(object):
             false if it was not (unreachable if failing hard)
         """
         assert not self._started_locking, 'can only lock once'
-        assert not self._started_locking, 'can only lock once'
-        start_time = time.time()
+        deadline = mono_ns() + int(self.acquire_timeout_ms) * 1000000
+
+        is_success = False
+        if _acquire_local(self, deadline):
+            try:
+                is_success = self._acquire_consul_lock(deadline)
+            finally:
+                if not is_success:
+                    _release_local(self)
+
+        if not is_success and fail_hard:
+            raise LockAcquisitionException("Failed to acquire %s" % self.full_key)
+        else:
+            return is_success
 
-        # how long to hold locks after session times out.
-        # we don't want to hold on to them since this is a temporary session just for this lock
-        session_lock_delay = 0
+    def _acquire_consul_lock(self, deadline):
+        """
+        Get a session for this lock and try to acquire the key in Consul until `deadline`.
+        """
+        self._start_session()
 
-        # how long to keep the session alive without a renew (heartbeat/keepalive) sent.
-        # we are using this to timeout the individual lock
-        session_ttl = self.lock_timeout_seconds
+        while True:
+            is_success = self._acquire_consul_key()
 
-        # delete locks when session is invalidated/destroyed
-        session_invalidate_behavior = 'delete'
+            time_left_ms = (deadline - mono_ns()) // 1000000
 
-        self.session_id = self._consul.session.create(
-            lock_delay=session_lock_delay,
-            ttl=session_ttl,
-            behavior=session_invalidate_behavior
-        )
+            if is_success or time_left_ms <= 0:
+                break
 
-        self._started_locking = True
+            # rather than polling, let Consul tell us when the lock changes hands
+            self._wait_for_release(time_left_ms)
 
-        is_success = False
+            sleep_ms = retry_jitter_ms(deadline)
+            if sleep_ms > 0:
+                _sleep(sleep_ms / 1000.0)
 
-        max_loop_iter = 1000  # don't loop forever
-        for attempt_number in range(0, max_loop_iter):
-            is_success = self._acquire_consul_key()
+        return is_success
 
-            # exponential backoff yo
-            sleep_ms = 50 * pow(attempt_number, 2)
-            elapsed_time_ms = int(round(1000 * (time.time() - start_time)))
-            time_left_ms = self.acquire_timeout_ms - elapsed_time_ms
-            sleep_ms = min(time_left_ms, sleep_ms)
+    @classmethod
+    def acquire_many(cls, locks, fail_hard=True):
+        """
+        Acquire several locks at once with a single Consul transaction per consul client. Either
+        all of them are acquired or none are. This makes a single attempt, it doesn't wait for
+        locks held elsewhere regardless of `acquire_timeout_ms`.
 
-            retry_acquire = (not is_success) and (time_left_ms > 0)
+        Each lock still has to be released on its own.
 
-            if retry_acquire:
-                sleep_seconds_float = sleep_ms / 1000.0
-                time.sleep(sleep_seconds_float)
+        :param locks: locks which haven't been acquired yet
+        :param fail_hard: same as for `acquire`
+
+        :return: True if all the locks were successfully acquired,
+            false if none were (unreachable if failing hard)
+        """
+        locks = list(locks)
+        for lock in locks:
+            assert not lock._started_locking, 'can only lock once'
+
+        is_success = False
+        claimed = []
+        try:
+            now = mono_ns()
+            for lock in locks:
+                if not _acquire_local(lock, now):
+                    break
+                claimed.append(lock)
             else:
-                break
+                is_success = cls._acquire_many_consul_keys(locks)
+        finally:
+            if not is_success:
+                for lock in claimed:
+                    try:
+                        lock.release()
+                    except Exception:
+                        # don't hide why acquiring failed, or skip cleaning up the other locks.
+                        # whatever is left in Consul goes away with the session's TTL
+                        pass
+
+                    if not lock._started_locking:
+                        # release() does nothing for locks that never got a session
+                        _release_local(lock)
 
         if not is_success and fail_hard:
-            raise LockAcquisitionException("Failed to acquire %s" % self.full_key)
+            raise LockAcquisitionException(
+                "Failed to acquire %s" % ', '.join(lock.full_key for lock in locks))
         else:
             return is_success
 
+    @staticmethod
+    def _acquire_many_consul_keys(locks):
+        locks_by_client = {}
+        for lock in locks:
+            lock._start_session()
+            locks_by_client.setdefault(lock._consul, []).append(lock)
+
+        for consul_client, client_locks in locks_by_client.items():
+            operations = []
+            for lock in client_locks:
+                value = defaults.generate_value()
+                if not isinstance(value, bytes):
+                    value = value.encode('utf-8')
+                operations.append({
+                    'KV': {
+                        'Verb': 'lock',
+                        'Key': lock.full_key,
+                        'Session': lock.session_id,
+                        'Value': base64.b64encode(value).decode('ascii'),
+                    }
+                })
+
+            try:
+                consul_client.txn.put(operations)
+            except consul.base.ClientError:
+                # Consul rolls back the whole transaction when any of the keys is already locked
+                return False
+
+        return True
+
+    def _start_session(self):
+        self._session_is_shared = self.use_session_pool
+        if self._session_is_shared:
+            self.session_id = get_session_pool(self._consul).get(self.lock_timeout_seconds)
+        else:
+            self.session_id = create_session(self._consul, self.lock_timeout_seconds)
+
+        self._started_locking = True
+
     def _acquire_consul_key(self):
         assert self.session_id, 'must have a session id to acquire lock'
 
@@ -133,30 +373,77 @@ class EphemeralLock(object):
             acquire=self.session_id
         )
 
+    def _wait_for_release(self, time_left_ms):
+        """
+        Block until the key is modified (most likely released by its current holder),
+        or until `time_left_ms` runs out, using a Consul blocking query.
+
+        More info:
+        https://www.consul.io/api/index.html#blocking-queries
+        """
+        index, data = self._consul.kv.get(self.full_key)
+        if data is None or not data.get('Session'):
+            # the lock was freed right after our attempt, no reason to wait
+            return
+
+        self._consul.kv.get(
+            self.full_key,
+            index=index,
+            wait=blocking_query_wait(time_left_ms)
+        )
+
     def release(self):
         """
         Release the lock immediately. Does nothing if never locked.
+
+        When releasing asynchronously, the lock may still be held in Consul for a moment after this
+        returns, this returns True without knowing if destroying the session succeeded.
         """
         if not self._started_locking:
             return False
 
         # destroying the session will is the safest way to release the lock. we'd like to delete the
         # key, but since it's possible we don't actually have the lock anymore (in distributed systems, there is no spoon)
-        # it's best to just destroy the session and let the lock get cleaned up by Consul
+        # it's best to just destroy the session and let the lock get cleaned up by Consul.
+        # A shared session has to outlive this lock though, so then only the key is released,
+        # which likewise does nothing if the session no longer holds it.
         #
         # More info:
         # https://www.consul.io/docs/internals/sessions.html
-        return self._consul.session.destroy(
-            session_id=self.session_id
-        )
+        # https://www.consul.io/api/kv.html#release
+        try:
+            if self._session_is_shared:
+                return self._consul.kv.put(
+                    key=self.full_key,
+                    value=None,
+                    release=self.session_id
+                )
+
+            if self.async_release:
+                _destroy_session_later(self._consul, self.session_id)
+                return True
+
+            return self._consul.session.destroy(
+                session_id=self.session_id
+            )
+        finally:
+            _release_local(self)
 
-    @contextlib.contextmanager
     def hold(self):
         """
-        Context manager for holding the lock
+        Context manager for holding the lock, the lock itself can also be used directly in a with block
         """
+        return self
+
+    def __enter__(self):
         try:
             self.acquire(fail_hard=True)
-            yield
-        finally:
+        except BaseException:
+            # __exit__ won't run, don't leave the session around until its TTL
             self.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
@@ -0,0 +1,129 @@
+"""
+Long-lived Consul sessions shared between locks, so acquiring a lock doesn't need to create
+(and releasing it destroy) a session of its own.
+"""
+import threading
+
+import consul
+
+
+SESSION_KWARGS = {
+    # how long to hold locks after session times out.
+    # we don't want to hold on to them, locks are meant to go away along with their session
+    'lock_delay': 0,
+
+    # delete locks when session is invalidated/destroyed
+    'behavior': 'delete',
+}
+
+
+# how soon to retry after failing to renew a session, well within the half TTL (at least 5s)
+# left before Consul may invalidate it
+_RENEW_RETRY_SECONDS = 2
+
+
+def create_session(consul_client, ttl):
+    """
+    Create a session for holding locks.
+
+    :param ttl: how long to keep the session alive without a renew (heartbeat/keepalive) sent.
+    :return: the session id
+    """
+    kwargs = SESSION_KWARGS.copy()
+    kwargs['ttl'] = ttl
+    return consul_client.session.create(**kwargs)
+
+
+class SessionPool(object):
+    """
+    Hands out one Consul session per TTL for a consul client, each kept alive by a background
+    thread renewing it every ttl/2 seconds.
+
+    Since a pooled session only gets invalidated once this process stops renewing it (e.g. the
+    process dies), locks using it can only be released explicitly or by that invalidation,
+    `lock_timeout_seconds` no longer bounds how long an unreleased lock is held.
+
+    Consul lets a session re-acquire a key it already holds, so pooled locks rely on the
+    in-process locking in `consul_lock.lock_impl` to keep them exclusive within one process,
+    which is why their local claims last until released rather than lapsing with the TTL.
+    """
+
+    def __init__(self, consul_client):
+        self._consul = consul_client
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get(self, ttl):
+        """
+        :param ttl: the session TTL in seconds, between 10 and 86400
+        :return: id of a live session with the given TTL
+        """
+        with self._lock:
+            session = self._sessions.get(ttl)
+            if session is None or not session.is_alive():
+                session = _RenewedSession(self._consul, ttl)
+                self._sessions[ttl] = session
+            return session.session_id
+
+    def close(self):
+        """
+        Stop renewing and destroy all the sessions in the pool.
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+
+        for session in sessions:
+            session.stop()
+
+
+class _RenewedSession(threading.Thread):
+
+    def __init__(self, consul_client, ttl):
+        super(_RenewedSession, self).__init__()
+        self.daemon = True
+        self.ttl = ttl
+        self._consul = consul_client
+        self._stopped = threading.Event()
+
+        self.session_id = create_session(consul_client, ttl)
+        self.start()
+
+    def run(self):
+        interval = self.ttl / 2.0
+        while not self._stopped.wait(interval):
+            try:
+                self._consul.session.renew(self.session_id)
+            except consul.NotFound:
+                # Consul already invalidated the session, the pool will create a new one
+                return
+            except Exception:
+                # the session can expire one TTL after the last successful renew, which is only
+                # another half TTL away, so try again soon rather than waiting out the interval
+                interval = _RENEW_RETRY_SECONDS
+            else:
+                interval = self.ttl / 2.0
+
+    def stop(self):
+        self._stopped.set()
+        try:
+            self._consul.session.destroy(session_id=self.session_id)
+        except Exception:
+            # the session will expire on its own anyway
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_session_pool(consul_client):
+    """
+    :return: the process wide SessionPool for `consul_client`
+    """
+    with _pools_lock:
+        pool = _pools.get(consul_client)
+        if pool is None:
+            pool = SessionPool(consul_client)
+            _pools[consul_client] = pool
+        return pool
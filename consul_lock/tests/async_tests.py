@@ -0,0 +1,158 @@
+from unittest import IsolatedAsyncioTestCase
+
+import json
+from consul_lock import defaults
+from consul_lock import LockAcquisitionException
+from consul_lock import async_lock
+from consul_lock.async_lock import AsyncEphemeralLock
+from mock import ANY
+from mock import AsyncMock
+from mock import MagicMock
+from mock import call
+from mock import patch
+
+
+class AsyncEphemeralLockTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        super(AsyncEphemeralLockTests, self).setUp()
+        self.session_id = 'fake-session'
+        self.key = 'fake-key'
+
+        self.mock_consul = MagicMock()
+        self.mock_consul.http.base_uri = 'http://consul:8500'
+        self.mock_consul.token = None
+        self.mock_consul.dc = None
+        defaults.consul_client = self.mock_consul
+        defaults.lock_key_pattern = '%s'
+
+        patcher = patch.object(AsyncEphemeralLock, '_request', new_callable=AsyncMock)
+        self.addCleanup(patcher.stop)
+        self.mock_request = patcher.start()
+        self.kv_put_results = [True]
+        self.kv_get_results = []
+        self.mock_request.side_effect = self._fake_request
+
+    async def _fake_request(self, method, path, params=None, data=None, timeout=None):
+        if path == '/v1/session/create':
+            return None, {'ID': self.session_id}
+        if path.startswith('/v1/session/destroy/'):
+            return None, True
+        if method == 'PUT':
+            return None, self.kv_put_results.pop(0)
+        return self.kv_get_results.pop(0)
+
+    def _session_create_call(self, ttl):
+        return call('PUT', '/v1/session/create', data=json.dumps({
+            'LockDelay': '0s',
+            'Behavior': 'delete',
+            'TTL': '%ss' % ttl,
+        }))
+
+    def _acquire_call(self):
+        return call('PUT', '/v1/kv/%s' % self.key, params={'acquire': self.session_id}, data=ANY)
+
+    async def test_simple_success(self):
+        lock = AsyncEphemeralLock(self.key)
+        self.assertTrue(await lock.acquire())
+        self.assertTrue(await lock.release())
+
+        self.assertEqual([
+            self._session_create_call(defaults.lock_timeout_seconds),
+            self._acquire_call(),
+            call('PUT', '/v1/session/destroy/%s' % self.session_id),
+        ], self.mock_request.mock_calls)
+
+    async def test_simple_success_context_manager(self):
+        async with AsyncEphemeralLock(self.key, lock_timeout_seconds=20):
+            self.assertEqual([
+                self._session_create_call(20),
+                self._acquire_call(),
+            ], self.mock_request.mock_calls)
+
+        self.mock_request.assert_called_with('PUT', '/v1/session/destroy/%s' % self.session_id)
+
+    async def test_fail_hard_raises(self):
+        self.kv_put_results = [False]
+        lock = AsyncEphemeralLock(self.key, acquire_timeout_ms=0)
+        with self.assertRaises(LockAcquisitionException):
+            await lock.acquire()
+
+    async def test_context_manager_releases_if_not_acquired(self):
+        self.kv_put_results = [False]
+        with self.assertRaises(LockAcquisitionException):
+            async with AsyncEphemeralLock(self.key, acquire_timeout_ms=0):
+                self.fail('should have raised an exception')
+
+        self.mock_request.assert_called_with('PUT', '/v1/session/destroy/%s' % self.session_id)
+
+    async def test_blocking_query_wait_for_release(self):
+        self.kv_put_results = [False, True]
+        self.kv_get_results = [
+            ('42', [{'Key': self.key, 'Session': 'other-session'}]),
+            ('43', None),
+        ]
+        lock = AsyncEphemeralLock(self.key, acquire_timeout_ms=10 * 1000)
+        self.assertTrue(await lock.acquire())
+
+        self.assertEqual([
+            self._session_create_call(defaults.lock_timeout_seconds),
+            self._acquire_call(),
+            call('GET', '/v1/kv/%s' % self.key),
+            call('GET', '/v1/kv/%s' % self.key, params={'index': '42', 'wait': ANY}, timeout=ANY),
+            self._acquire_call(),
+        ], self.mock_request.mock_calls)
+
+    async def test_blocking_query_outlasts_http_timeout(self):
+        self.kv_put_results = [False, True]
+        self.kv_get_results = [
+            ('42', [{'Key': self.key, 'Session': 'other-session'}]),
+            ('43', None),
+        ]
+        lock = AsyncEphemeralLock(self.key, acquire_timeout_ms=20 * 60 * 1000)
+        self.assertTrue(await lock.acquire())
+
+        blocking_query = self.mock_request.mock_calls[3]
+        self.assertEqual({'index': '42', 'wait': ANY}, blocking_query.kwargs['params'])
+        self.assertGreater(blocking_query.kwargs['timeout'].total, 600)
+
+    async def test_release_gracefully_if_never_locked(self):
+        lock = AsyncEphemeralLock(self.key)
+        self.assertFalse(await lock.release())
+        self.assertEqual([], self.mock_request.mock_calls)
+
+
+class AsyncHttpSessionTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        super(AsyncHttpSessionTests, self).setUp()
+        self.mock_consul = MagicMock()
+        self.mock_consul.http.base_uri = 'http://consul:8500'
+        self.mock_consul.token = None
+        self.mock_consul.dc = None
+
+    async def test_uses_given_http_session(self):
+        mock_response = MagicMock()
+        mock_response.status = 200
+        mock_response.headers = {'X-Consul-Index': '42'}
+        mock_response.text = AsyncMock(return_value='true')
+        mock_http_session = MagicMock()
+        mock_http_session.request.return_value.__aenter__.return_value = mock_response
+
+        lock = AsyncEphemeralLock(
+            'fake-key', consul_client=self.mock_consul, http_session=mock_http_session)
+        self.assertEqual(('42', True), await lock._request('PUT', '/v1/kv/fake-key'))
+
+        mock_http_session.request.assert_called_once_with(
+            'PUT', 'http://consul:8500/v1/kv/fake-key', params=None, data=None, headers=None)
+        self.assertEqual({}, async_lock._http_sessions)
+
+    async def test_close_http_session(self):
+        http_session = async_lock._get_http_session()
+        self.assertIs(http_session, async_lock._get_http_session())
+
+        await async_lock.close_http_session()
+        self.assertTrue(http_session.closed)
+        self.assertEqual({}, async_lock._http_sessions)
+
+        new_http_session = async_lock._get_http_session()
+        self.assertIsNot(http_session, new_http_session)
+        await async_lock.close_http_session()
@@ -1,9 +1,17 @@
 from unittest import TestCase
 
+import base64
 import consul
 import json
+import threading
 from consul_lock import defaults
+from consul_lock import lock_impl
+from consul_lock import session_pool
 from consul_lock import EphemeralLock
+from consul_lock import LockAcquisitionException
+from consul_lock import make_pooled_client
+from mock import ANY
+from mock import call
 from mock import patch
 from mock import MagicMock
 
@@ -21,7 +29,8 @@ class JsonKeyMatcher(object):
         self.keys = set(keys)
 
     def __eq__(self, other):
-        other_dict = json.loads(other)
+        # values are generated as bytes, which json.loads only accepts as of python 3.6
+        other_dict = json.loads(other.decode('utf-8') if isinstance(other, bytes) else other)
         return self.keys == set(other_dict.keys())
 
     def __str__(self):
@@ -42,6 +51,9 @@ class EphemeralLockTests(TestCase):
         defaults.consul_client = self.mock_consul
         defaults.lock_key_pattern = '%s'
 
+        # locks left held by a test shouldn't be contended by the next one
+        self.addCleanup(lock_impl._local_holders.clear)
+
     def _setup_mock_consul(self, mock_consul):
         mock_consul.session.create.return_value = self.session_id
         mock_consul.kv.put.return_value = True
@@ -119,6 +131,50 @@ class EphemeralLockTests(TestCase):
             session_id=self.session_id
         )
 
+    def test_consul_client_required(self):
+        defaults.consul_client = None
+        self.assertRaises(Exception, EphemeralLock, self.key)
+
+    def test_lock_key_pattern(self):
+        defaults.lock_key_pattern = 'locks/100%%/%s/lock'
+        lock = EphemeralLock(self.key)
+        self.assertEqual('locks/100%/fake-key/lock', lock.full_key)
+
+        defaults.lock_key_pattern = 'other/%s'
+        lock = EphemeralLock(self.key)
+        self.assertEqual('other/fake-key', lock.full_key)
+
+        lock = EphemeralLock(123)
+        self.assertEqual('other/123', lock.full_key)
+
+    def test_lock_as_context_manager(self):
+        lock = EphemeralLock(self.key)
+        with lock as held_lock:
+            self.assertIs(lock, held_lock)
+            self.mock_consul.kv.put.assert_called_once_with(
+                key=self.key,
+                value=self.value_matcher,
+                acquire=self.session_id
+            )
+            self.assertEqual([], self.mock_consul.session.destroy.mock_calls)
+
+        self.mock_consul.session.destroy.assert_called_once_with(
+            session_id=self.session_id
+        )
+
+    def test_context_manager_releases_if_not_acquired(self):
+        self.mock_consul.kv.put.return_value = False
+        lock = EphemeralLock(self.key, acquire_timeout_ms=0)
+        try:
+            with lock:
+                self.fail('should have raised an exception')
+        except LockAcquisitionException:
+            pass
+
+        self.mock_consul.session.destroy.assert_called_once_with(
+            session_id=self.session_id
+        )
+
     def test_release_gracefully_if_never_locked(self):
         lock = EphemeralLock(self.key)
         self.mock_consul.session.create.side_effect = consul.Timeout('unable to create session')
@@ -135,3 +191,260 @@ class EphemeralLockTests(TestCase):
         self.assertEquals([], self.mock_consul.kv.put.mock_calls)
         self.assertEquals([], self.mock_consul.session.destroy.mock_calls)
 
+
+    def test_fail_without_waiting(self):
+        self.mock_consul.kv.put.return_value = False
+        lock = EphemeralLock(self.key, acquire_timeout_ms=0)
+        self.assertFalse(lock.acquire(fail_hard=False))
+
+        self.mock_consul.kv.put.assert_called_once_with(
+            key=self.key,
+            value=self.value_matcher,
+            acquire=self.session_id
+        )
+        self.assertEqual([], self.mock_consul.kv.get.mock_calls)
+
+    def test_fail_hard_raises(self):
+        self.mock_consul.kv.put.return_value = False
+        lock = EphemeralLock(self.key, acquire_timeout_ms=0)
+        self.assertRaises(LockAcquisitionException, lock.acquire)
+
+    def test_blocking_query_wait_for_release(self):
+        self.mock_consul.kv.put.side_effect = [False, True]
+        self.mock_consul.kv.get.side_effect = [
+            (42, {'Key': self.key, 'Session': 'other-session'}),
+            (43, None),
+        ]
+        lock = EphemeralLock(self.key, acquire_timeout_ms=10 * 1000)
+        self.assertTrue(lock.acquire())
+
+        self.assertEqual(2, len(self.mock_consul.kv.put.mock_calls))
+        self.assertEqual([
+            call(self.key),
+            call(self.key, index=42, wait=ANY),
+        ], self.mock_consul.kv.get.mock_calls)
+
+    def test_retry_jitter_stays_small(self):
+        deadline = lock_impl.mono_ns() + 60 * 1000 * 1000000
+        for _ in range(100):
+            self.assertLessEqual(lock_impl.retry_jitter_ms(deadline), 50)
+
+        self.assertLessEqual(lock_impl.retry_jitter_ms(lock_impl.mono_ns()), 0)
+
+    def test_retry_immediately_if_released_after_attempt(self):
+        self.mock_consul.kv.put.side_effect = [False, True]
+        self.mock_consul.kv.get.return_value = (42, None)
+        lock = EphemeralLock(self.key, acquire_timeout_ms=10 * 1000)
+        self.assertTrue(lock.acquire())
+
+        self.assertEqual(2, len(self.mock_consul.kv.put.mock_calls))
+        self.mock_consul.kv.get.assert_called_once_with(self.key)
+
+    def test_same_process_contention_settled_locally(self):
+        lock1 = EphemeralLock(self.key)
+        lock2 = EphemeralLock(self.key, acquire_timeout_ms=0)
+        lock1.acquire()
+        self.assertFalse(lock2.acquire(fail_hard=False))
+
+        self.mock_consul.session.create.assert_called_once_with(
+            lock_delay=0,
+            ttl=defaults.lock_timeout_seconds,
+            behavior='delete',
+        )
+        self.assertEqual(1, len(self.mock_consul.kv.put.mock_calls))
+
+        lock1.release()
+        lock3 = EphemeralLock(self.key, acquire_timeout_ms=0)
+        self.assertTrue(lock3.acquire(fail_hard=False))
+
+    def test_same_process_claim_lapses_with_lock_timeout(self):
+        mock_mono_ns = patch_object(self, lock_impl, 'mono_ns')
+        mock_mono_ns.return_value = 1000 * 1000000000
+        lock1 = EphemeralLock(self.key, lock_timeout_seconds=10)
+        lock1.acquire()
+
+        mock_mono_ns.return_value = 1010 * 1000000000
+        lock2 = EphemeralLock(self.key, acquire_timeout_ms=0)
+        self.assertTrue(lock2.acquire(fail_hard=False))
+
+    def test_same_process_pooled_claim_does_not_lapse(self):
+        self.addCleanup(session_pool.get_session_pool(self.mock_consul).close)
+        mock_mono_ns = patch_object(self, lock_impl, 'mono_ns')
+        mock_mono_ns.return_value = 1000 * 1000000000
+        lock1 = EphemeralLock(self.key, lock_timeout_seconds=10, use_session_pool=True)
+        lock1.acquire()
+
+        mock_mono_ns.return_value = 1011 * 1000000000
+        lock2 = EphemeralLock(self.key, acquire_timeout_ms=0, use_session_pool=True)
+        self.assertFalse(lock2.acquire(fail_hard=False))
+        self.assertEqual(1, len(self.mock_consul.kv.put.mock_calls))
+
+        lock1.release()
+        lock3 = EphemeralLock(self.key, acquire_timeout_ms=0, use_session_pool=True)
+        self.assertTrue(lock3.acquire(fail_hard=False))
+
+    def test_same_process_claim_released_if_not_acquired(self):
+        self.mock_consul.kv.put.return_value = False
+        lock1 = EphemeralLock(self.key, acquire_timeout_ms=0)
+        self.assertFalse(lock1.acquire(fail_hard=False))
+
+        self.mock_consul.kv.put.return_value = True
+        lock2 = EphemeralLock(self.key, acquire_timeout_ms=0)
+        self.assertTrue(lock2.acquire(fail_hard=False))
+
+    def test_async_release(self):
+        lock = EphemeralLock(self.key, async_release=True)
+        lock.acquire()
+        self.assertTrue(lock.release())
+
+        lock_impl._destroy_queue.join()
+        self.mock_consul.session.destroy.assert_called_once_with(
+            session_id=self.session_id
+        )
+
+    def test_async_release_restarts_dead_worker(self):
+        # e.g. after forking, only the thread that forked keeps running in the child
+        dead_worker = threading.Thread(target=lambda: None)
+        dead_worker.start()
+        dead_worker.join()
+        patch_object(self, lock_impl, '_destroy_worker', dead_worker)
+
+        lock = EphemeralLock(self.key, async_release=True)
+        lock.acquire()
+        self.assertTrue(lock.release())
+
+        lock_impl._destroy_queue.join()
+        self.assertTrue(lock_impl._destroy_worker.is_alive())
+        self.mock_consul.session.destroy.assert_called_once_with(
+            session_id=self.session_id
+        )
+
+    def test_session_pool(self):
+        self.addCleanup(session_pool.get_session_pool(self.mock_consul).close)
+        lock1 = EphemeralLock('fake-key-1', use_session_pool=True)
+        lock2 = EphemeralLock('fake-key-2', use_session_pool=True)
+        lock1.acquire()
+        lock2.acquire()
+
+        self.mock_consul.session.create.assert_called_once_with(
+            lock_delay=0,
+            ttl=defaults.lock_timeout_seconds,
+            behavior='delete',
+        )
+        self.mock_consul.kv.put.assert_has_calls([
+            call(key='fake-key-1', value=self.value_matcher, acquire=self.session_id),
+            call(key='fake-key-2', value=self.value_matcher, acquire=self.session_id),
+        ])
+
+        # the session is picked when acquiring, changing the setting afterwards doesn't matter
+        lock1.use_session_pool = False
+        lock1.release()
+        self.mock_consul.kv.put.assert_called_with(
+            key='fake-key-1',
+            value=None,
+            release=self.session_id
+        )
+        self.assertEqual([], self.mock_consul.session.destroy.mock_calls)
+
+    def test_session_pool_replaces_invalidated_session(self):
+        pool = session_pool.SessionPool(self.mock_consul)
+        self.addCleanup(pool.close)
+        self.mock_consul.session.create.side_effect = ['session-1', 'session-2']
+        self.assertEqual('session-1', pool.get(10))
+        self.assertEqual('session-1', pool.get(10))
+
+        # sessions that are no longer being renewed get replaced
+        pool._sessions[10].stop()
+        pool._sessions[10].join()
+        self.assertEqual('session-2', pool.get(10))
+
+    def test_session_pool_retries_failed_renew_soon(self):
+        self.mock_consul.session.renew.side_effect = [consul.Timeout('unable to renew'), None, None]
+        session = session_pool._RenewedSession.__new__(session_pool._RenewedSession)
+        session.ttl = 30
+        session.session_id = self.session_id
+        session._consul = self.mock_consul
+        session._stopped = MagicMock()
+        session._stopped.wait.side_effect = [False, False, False, True]
+        session.run()
+
+        self.assertEqual([
+            call(15.0),
+            call(session_pool._RENEW_RETRY_SECONDS),
+            call(15.0),
+            call(15.0),
+        ], session._stopped.wait.mock_calls)
+
+    def test_acquire_many(self):
+        self.mock_consul.session.create.side_effect = ['session-1', 'session-2']
+        lock1 = EphemeralLock('fake-key-1')
+        lock2 = EphemeralLock('fake-key-2')
+        self.assertTrue(EphemeralLock.acquire_many([lock1, lock2]))
+
+        self.assertEqual([], self.mock_consul.kv.put.mock_calls)
+        self.mock_consul.txn.put.assert_called_once_with([
+            {'KV': {'Verb': 'lock', 'Key': 'fake-key-1', 'Session': 'session-1', 'Value': ANY}},
+            {'KV': {'Verb': 'lock', 'Key': 'fake-key-2', 'Session': 'session-2', 'Value': ANY}},
+        ])
+        operations = self.mock_consul.txn.put.call_args[0][0]
+        for operation in operations:
+            self.assertEqual(self.value_matcher, base64.b64decode(operation['KV']['Value']))
+
+        lock1.release()
+        lock2.release()
+        self.assertEqual([
+            call(session_id='session-1'),
+            call(session_id='session-2'),
+        ], self.mock_consul.session.destroy.mock_calls)
+
+    def test_acquire_many_all_or_nothing(self):
+        self.mock_consul.session.create.side_effect = ['session-1', 'session-2']
+        self.mock_consul.txn.put.side_effect = consul.base.ClientError('409 rolled back')
+        lock1 = EphemeralLock('fake-key-1')
+        lock2 = EphemeralLock('fake-key-2')
+        self.assertFalse(EphemeralLock.acquire_many([lock1, lock2], fail_hard=False))
+
+        self.assertEqual([
+            call(session_id='session-1'),
+            call(session_id='session-2'),
+        ], self.mock_consul.session.destroy.mock_calls)
+
+        self.mock_consul.session.create.side_effect = None
+        lock3 = EphemeralLock('fake-key-1', acquire_timeout_ms=0)
+        self.assertTrue(lock3.acquire(fail_hard=False))
+
+    def test_acquire_many_cleans_up_when_release_fails(self):
+        self.mock_consul.session.create.side_effect = ['session-1', 'session-2']
+        self.mock_consul.txn.put.side_effect = consul.base.ClientError('409 rolled back')
+        self.mock_consul.session.destroy.side_effect = consul.Timeout('unable to destroy session')
+        lock1 = EphemeralLock('fake-key-1')
+        lock2 = EphemeralLock('fake-key-2')
+        self.assertRaises(LockAcquisitionException, EphemeralLock.acquire_many, [lock1, lock2])
+
+        self.assertEqual([
+            call(session_id='session-1'),
+            call(session_id='session-2'),
+        ], self.mock_consul.session.destroy.mock_calls)
+        self.assertEqual({}, lock_impl._local_holders)
+
+    def test_acquire_many_contended_locally(self):
+        lock1 = EphemeralLock('fake-key-1')
+        lock1.acquire()
+        lock2 = EphemeralLock('fake-key-1')
+        lock3 = EphemeralLock('fake-key-2')
+        self.assertRaises(LockAcquisitionException, EphemeralLock.acquire_many, [lock3, lock2])
+
+        self.assertEqual([], self.mock_consul.txn.put.mock_calls)
+        lock4 = EphemeralLock('fake-key-2', acquire_timeout_ms=0)
+        self.assertTrue(lock4.acquire(fail_hard=False))
+
+
+class PooledClientTests(TestCase):
+    def test_make_pooled_client(self):
+        client = make_pooled_client('consul.local', 8501, pool_maxsize=50)
+
+        self.assertEqual('http://consul.local:8501', client.http.base_uri)
+        self.assertEqual('keep-alive', client.http.session.headers['Connection'])
+        for prefix in ('http://', 'https://'):
+            adapter = client.http.session.get_adapter(prefix + 'consul.local:8501')
+            self.assertEqual(50, adapter._pool_maxsize)
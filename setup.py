@@ -11,5 +11,6 @@ setup(
     packages=['consul_lock'],
     tests_require=['mock'],
     install_requires=['python-consul'],
+    extras_require={'async': ['aiohttp']},
     zip_safe=True
 )